@@ -1,29 +1,52 @@
 # overseas_companies_analysis.py
 # Analyze sampled Companies House data for director origins and compliance indicators
 
+import itertools
 import json
 import math
+import pathlib
+import re
+import sys
 from datetime import datetime
 
+import numpy as np
+import pandas as pd
+
+try:
+    import orjson  # much faster parsing of the (large) sample file, if installed
+except ImportError:
+    orjson = None
+
+try:
+    import ijson  # lets us stream the sample file rather than load it all, if installed
+except ImportError:
+    ijson = None
+
 # Constants
 INPUT_FILE = "overseas_directors_sample.json"
 UK_VARIANT_FILE = "overseas_companies_UK_variants.txt"
 Z95 = 1.96  # for 95% significance
+# Phrases marking an address as the Companies House default address (case-insensitive).
+# All of them are compiled into one pattern, so each address is scanned once however many there are
+DEFAULT_ADDRESS_PHRASES = ("default address",)
+DEFAULT_ADDRESS_RE = re.compile("|".join(map(re.escape, DEFAULT_ADDRESS_PHRASES)), re.IGNORECASE)
+DEFAULT_ADDRESS_SEARCH = DEFAULT_ADDRESS_RE.search
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_EMPTY = {}  # shared stand-in for a missing dict, so we don't allocate one each time (never mutated)
 
 
-def load_UK_variants():
+def load_UK_variants(path=UK_VARIANT_FILE):
     # it's a conservative list, including items where it's not clear the director is actually UK (e.g. "Property Consultant")
     # Read variants from a file, one per line
-    with open(UK_VARIANT_FILE, encoding="utf-8") as f:
-        # strip whitespace and skip empty lines
-        variations_on_uk = [line.strip() for line in f if line.strip()]
+    lines = pathlib.Path(path).read_text(encoding="utf-8").splitlines()
+    # strip whitespace and skip empty lines
+    variations_on_uk = [line.strip() for line in lines if line.strip()]
 
-    # Build a case-folded set
-    return {variant.casefold() for variant in variations_on_uk}
+    # Build a case-folded, immutable (and so hashable) set of interned strings
+    return frozenset(sys.intern(variant.casefold()) for variant in variations_on_uk)
 
-def inspect_countries(sampled, uk_variants):
+def inspect_countries(countries, uk_variants):
     # Display countries for inspection
-    countries = extract_director_countries(sampled)
     print(f"\nFound {len(countries)} unique director countries, excluding those I identify as UK:")
     for c in sorted(countries):
         if c.strip().casefold() not in uk_variants:
@@ -35,85 +58,272 @@ def load_sampled_companies(input_file):
     """
     Load the sampled companies JSON into a dictionary.
     """
-    with open(input_file, 'r') as f:
-        data = json.load(f)
+    data = None
+    if orjson is not None:
+        # orjson only succeeds on files without NaN. The sampling script used to write NaN for
+        # empty CSV cells, which isn't valid JSON, so for those files this attempt always fails
+        with open(input_file, 'rb') as f:
+            raw = f.read()
+        try:
+            data = orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            pass
+        del raw  # don't hold the bytes while the fallback parses the file again
+
+    if data is None:
+        with open(input_file, 'r') as f:
+            data = json.load(f)
     return data.get('sampled_companies', {})
 
 
-def extract_director_countries(sampled_companies):
+def _skip_whitespace(text, pos):
+    return JSON_WHITESPACE.match(text, pos).end()
+
+
+def _iter_sampled_companies_text(input_file):
+    """
+    Yield each sampled company's dict by walking the file's text and decoding one company at a
+    time with the stdlib decoder (which, unlike ijson, accepts NaN). Only the text is held in
+    memory, not the whole parsed sample.
+    """
+    with open(input_file, 'r') as f:
+        text = f.read()
+    decode = json.JSONDecoder().raw_decode
+
+    pos = _skip_whitespace(text, 0) + 1  # past the opening {
+    while True:
+        # top-level members: "metadata", "sampled_companies"
+        pos = _skip_whitespace(text, pos)
+        if text[pos] == '}':
+            return
+        key, pos = decode(text, pos)
+        pos = _skip_whitespace(text, _skip_whitespace(text, pos) + 1)  # past the :
+
+        if key == 'sampled_companies':
+            pos += 1  # past the {
+            while True:
+                pos = _skip_whitespace(text, pos)
+                if text[pos] == '}':
+                    break
+                _, pos = decode(text, pos)  # company number
+                pos = _skip_whitespace(text, _skip_whitespace(text, pos) + 1)  # past the :
+                info, pos = decode(text, pos)
+                yield info
+                pos = _skip_whitespace(text, pos)
+                if text[pos] == ',':
+                    pos += 1
+            pos += 1  # past the }
+        else:
+            _, pos = decode(text, pos)
+
+        pos = _skip_whitespace(text, pos)
+        if text[pos] == ',':
+            pos += 1
+
+
+def iter_sampled_companies(input_file):
+    """
+    Yield each sampled company's dict in turn, so the whole parsed sample is never held in
+    memory at once. With ijson installed the file is streamed.
+    """
+    if ijson is None:
+        yield from _iter_sampled_companies_text(input_file)
+        return
+
+    yielded = 0
+    try:
+        with open(input_file, 'rb') as f:
+            for _, info in ijson.kvitems(f, 'sampled_companies', use_float=True):
+                yield info
+                yielded += 1
+    except ijson.JSONError:
+        # files from older versions of the sampling script contain NaN for empty CSV cells,
+        # which isn't valid JSON and ijson rejects; carry on from where we got to by
+        # decoding the text one company at a time instead
+        yield from itertools.islice(_iter_sampled_companies_text(input_file), yielded, None)
+
+
+def _clean_country(country):
+    # stripped and interned (there are only a few hundred distinct values); None if not given
+    return sys.intern(country.strip()) if country else None
+
+
+def _is_uk(countries, uk_variants):
+    # only the distinct country strings are case-folded and looked up; a missing country
+    # gets code -1, which picks up the trailing False
+    codes, uniques = pd.factorize(countries)
+    uk_unique = np.array([country.casefold() in uk_variants for country in uniques] + [False], dtype=bool)
+    return uk_unique[codes]
+
+
+def _contains_default_address(strings):
+    return strings.str.contains(DEFAULT_ADDRESS_RE, na=False).astype(bool)
+
+
+def _clean_string(value):
+    # the JSON already holds strings (or NaN/null for empty cells), so no str() copy is needed;
+    # strip() hands back the same object when there's nothing to strip
+    return value.strip() if isinstance(value, str) else None
+
+
+def _parse_due_dates(values):
+    # to_datetime caches by unique value, and a few thousand distinct dates cover the sample
+    return pd.to_datetime(pd.Series(values, dtype=object), format='%d/%m/%Y', errors='coerce', cache=True).to_numpy()
+
+
+def _extract_columns(infos):
+    """
+    Pull the fields we use out of an iterable of company dicts, one company at a time,
+    numbering the companies from 0. Returns a dict of plain lists.
+    """
+    get = dict.get
+    search = DEFAULT_ADDRESS_SEARCH
+    join = '\n'.join  # newline-separated so the phrase can't match across two address fields
+
+    conf_due, acc_due, reg_addr = [], [], []
+    officer_company, residence, address_country, officer_default = [], [], [], []
+
+    for i, info in enumerate(infos):
+        data = get(info, 'company_data') or _EMPTY
+        conf_due.append(_clean_string(get(data, 'ConfStmtNextDueDate')))
+        acc_due.append(_clean_string(get(data, 'Accounts.NextDueDate')))
+        reg_addr.append(get(data, 'RegAddress.AddressLine1', ''))
+
+        for officer in get(info, 'directors', ()):
+            address = get(officer, 'address') or _EMPTY
+            officer_company.append(i)
+            # where they say they're resident, and where they give an address
+            residence.append(_clean_country(get(officer, 'country_of_residence') or get(officer, 'residence_country')))
+            address_country.append(_clean_country(get(address, 'country')))
+            # does any field of the director's service address mention the default address?
+            officer_default.append(bool(search(join([val for val in address.values() if isinstance(val, str)]))))
+
+    return {
+        'conf_due': conf_due, 'acc_due': acc_due, 'reg_addr': reg_addr,
+        'officer_company': officer_company, 'residence': residence,
+        'address_country': address_country, 'officer_default': officer_default,
+    }
+
+
+def build_frames(companies_info, uk_variants):
+    """
+    Flatten the sample into two DataFrames, built once and shared by all the analyses:
+    one row per director (classified by country and default address), and one row per
+    company (filing due dates, default address flags and the aggregated director columns).
+    companies_info is any iterable of company dicts; only the fields we need are kept,
+    so it can be a stream from iter_sampled_companies().
+    """
+    columns = _extract_columns(companies_info)
+
+    officers = pd.DataFrame({
+        '_company_id': np.array(columns['officer_company'], dtype=np.intp),
+        'country': pd.Series(columns['residence'], dtype=object),
+        'address_country': pd.Series(columns['address_country'], dtype=object),
+        'default_address': np.array(columns['officer_default'], dtype=bool),
+    })
+
+    # a director is UK if their residence AND address country is UK; UK residence
+    # with a non-UK address is a suspect case we keep track of
+    uk_resident = _is_uk(officers['country'], uk_variants)
+    uk_address = _is_uk(officers['address_country'], uk_variants)
+    officers['uk_resident_and_addr'] = uk_resident & uk_address
+    officers['questionable'] = uk_resident & ~uk_address
+
+    # Per-company totals of the director columns. Directors are stored company by company, and
+    # bincount gives 0 for companies with none (where np.add.reduceat would misbehave)
+    n_companies = len(columns['conf_due'])
+    company_id = officers['_company_id'].to_numpy()
+
+    def per_company(flags):
+        return np.bincount(company_id, weights=officers[flags].to_numpy(), minlength=n_companies).astype(np.int64)
+
+    # One row per company
+    companies = pd.DataFrame({
+        # the company has a UK director if any of its directors is UK resident and addressed
+        'has_uk': per_company('uk_resident_and_addr') > 0,
+        'n_directors': np.bincount(company_id, minlength=n_companies),
+        'questionable': per_company('questionable'),
+        # anything missing or unparseable becomes NaT, which never counts as late
+        'conf_due': _parse_due_dates(columns['conf_due']),
+        'acc_due': _parse_due_dates(columns['acc_due']),
+        'reg_addr_default': _contains_default_address(pd.Series(columns['reg_addr'], dtype=object)).to_numpy(),
+        'officer_default': per_company('default_address'),
+    })
+    return companies, officers
+
+
+def extract_director_countries(officers):
     """
     Collect unique country strings from all directors in the sample.
     This is to make sure the user has correctly added all UK variants in the sample to the variants text file
     """
-    countries = set()
-    for info in sampled_companies.values():
-        for officer in info.get('directors', []):
-            
-            country = officer.get('country_of_residence') or officer.get('residence_country')
-            address_country = officer.get('address', {}).get('country')
-            
-            # where they say they're resident
-            if country:
-                countries.add(country.strip())
-            
-            # where they give an address
-            if address_country:
-                countries.add(address_country.strip())
-            
-    return countries
-
-
-def count_companies_by_uk_director_status(sampled_companies, uk_variants):
+    # the columns are already stripped, with None where no country was given
+    return set(officers['country'].dropna()) | set(officers['address_country'].dropna())
+
+
+def count_companies_by_uk_director_status(companies):
     """
     Return dicts for total counts and classification of companies by UK director presence.
     """
-    counts = {'with_uk': 0, 'without_uk': 0, 'questionable_residence': 0, 'total_directors': 0}
-        
-    for info in sampled_companies.values():
-        has_uk = False
-        
-        for officer in info.get('directors', []):
-            
-            counts['total_directors'] += 1
-            
-            country = officer.get('country_of_residence') or officer.get('residence_country')       
-            address_country = officer.get('address', {}).get('country')
-                
-            # if any director is in the UK then we mark this company as having a UK director   
-            if country and country.strip().casefold() in uk_variants:
-                
-                # provided their stated address is also the UK. 
-                if address_country and address_country.strip().casefold() in uk_variants:
-                    has_uk = True
-
-                # Keep track of such suspect cases
-                else:
-                    counts['questionable_residence'] += 1
-                    
-        if has_uk:
-            counts['with_uk'] += 1
-        else:
-            counts['without_uk'] += 1
-        
-            
+    with_uk = int(companies['has_uk'].sum())
+    counts = {
+        'with_uk': with_uk,
+        'without_uk': len(companies) - with_uk,
+        'questionable_residence': int(companies['questionable'].sum()),
+        'total_directors': int(companies['n_directors'].sum()),
+    }
     counts['total_companies'] = counts['with_uk'] + counts['without_uk']
     return counts
 
-def count_foreign_and_uk_directors(sampled, uk_variants):
+def proportion_moe(count, n, z):
+    """
+    Proportion count/n and its margin of error (Wald interval). Both are 0 if n is 0.
+    """
+    if n == 0:
+        return 0.0, 0.0
+    p = count / n
+    return p, z * math.sqrt(p * (1 - p) / n)
+
+
+def ratio_moe(count_a, n_a, count_b, n_b, z):
+    """
+    Ratio of the proportions count_a/n_a to count_b/n_b, and its margin of error.
+    """
+    p_a, moe_a = proportion_moe(count_a, n_a, z)
+    p_b, moe_b = proportion_moe(count_b, n_b, z)
+
+    ratio = p_a / p_b
+
+    # Calculate margin of error for the ratio R = P_a / P_b
+    # (MOE_R / R)^2 = (MOE_P_a / P_a)^2 + (MOE_P_b / P_b)^2
+    # A proportion of 0 or 1 has a MOE of 0 (Wald interval), and so contributes no uncertainty
+    rel_err_sq_a = 0.0
+    if p_a > 0 and moe_a > 0:
+        rel_err_sq_a = (moe_a / p_a) ** 2
+
+    rel_err_sq_b = 0.0
+    if p_b > 0 and moe_b > 0:
+        rel_err_sq_b = (moe_b / p_b) ** 2
+
+    moe_ratio = 0.0
+    if ratio != 0 and (rel_err_sq_a > 0 or rel_err_sq_b > 0):
+        moe_ratio = abs(ratio) * math.sqrt(rel_err_sq_a + rel_err_sq_b)
+    return ratio, moe_ratio
+
+
+def count_foreign_and_uk_directors(companies):
     # Basic UK director stats
-    counts = count_companies_by_uk_director_status(sampled, uk_variants)
+    counts = count_companies_by_uk_director_status(companies)
     
     
     with_uk = counts['with_uk']
     without_uk = counts['without_uk']
     total_companies = counts['total_companies']
-    pct_foreign = without_uk / total_companies if total_companies else 0
-    moe_foreign = Z95 * math.sqrt(pct_foreign * (1 - pct_foreign) / total_companies) if total_companies else 0
+    pct_foreign, moe_foreign = proportion_moe(without_uk, total_companies, Z95)
     
     questionable_residence = counts['questionable_residence']
     total_directors = counts['total_directors']
-    pct_questionable_residence = questionable_residence / total_directors if total_directors else 0
-    moe_questionable_residence = Z95 * math.sqrt(pct_questionable_residence * (1 - pct_questionable_residence) / total_directors) if total_directors else 0
+    pct_questionable_residence, moe_questionable_residence = proportion_moe(questionable_residence, total_directors, Z95)
 
     print(f"\nTotal: {total_companies:,}, with UK director: {with_uk:,}, without: {without_uk:,}")
     print(f"Proportion companies all-foreign: {pct_foreign * 100:.1f}% ±{moe_foreign * 100:.2f}%")
@@ -122,63 +332,33 @@ def count_foreign_and_uk_directors(sampled, uk_variants):
     return counts
 
 
-def analyze_compliance(sampled_companies, uk_variants):
+def analyze_compliance(companies):
     """
     Analyze compliance indicators for companies with/without UK directors.
     Returns a dict with metrics for each group.
     """
-    # Initialize structure
-    metrics = {
-        'with_uk': {'late_confstmt': 0, 'late_accounts': 0, 'default_address': 0},
-        'without_uk': {'late_confstmt': 0, 'late_accounts': 0, 'default_address': 0}
-    }
-    today = datetime.utcnow().date()
-
-    for info in sampled_companies.values():
-        # Determine group
-        has_uk = False
-        for officer in info.get('directors', []):
-            country = officer.get('country_of_residence') or officer.get('residence_country')
-            address_country = officer.get('address', {}).get('country')            
-            
-            # mark director as UK if their residence AND address country is UK
-            if (country and country.strip().casefold() in uk_variants) and (address_country and address_country.strip().casefold() in uk_variants):
-                has_uk = True
-                break
-        group = 'with_uk' if has_uk else 'without_uk'
-
-        data = info.get('company_data', {})
+    today = np.datetime64(datetime.utcnow().date())
+    groups = ['with_uk', 'without_uk']
+    keys = ['late_confstmt', 'late_accounts', 'default_address']
+
+    # row 0 of the totals is with_uk, row 1 without_uk
+    group_index = (~companies['has_uk'].to_numpy()).astype(np.intp)
+    flags = [
         # Late confirmation statement?
-        conf_due = str(data.get('ConfStmtNextDueDate', '')).strip()
-        try:
-            conf_date = datetime.strptime(conf_due, '%d/%m/%Y').date()
-            if conf_date < today:
-                metrics[group]['late_confstmt'] += 1
-        except Exception:
-            pass
+        companies['conf_due'].to_numpy() < today,
         # Late accounts filing?
-        acc_due = str(data.get('Accounts.NextDueDate', '')).strip()
-        try:
-            acc_date = datetime.strptime(acc_due, '%d/%m/%Y').date()
-            if acc_date < today:
-                metrics[group]['late_accounts'] += 1
-        except Exception:
-            pass
-        
-        # Default office address?
-        addr = str(data.get('RegAddress.AddressLine1', '')).strip()
-        if 'default address' in addr.lower():
-            metrics[group]['default_address'] += 1
-
-        # Check each director's service address if company address not flagged
-        else:
-            for officer in info.get('directors', []):
-                director_address = officer.get('address', {}) or {}
-                for val in director_address.values():
-                    if isinstance(val, str) and 'default address' in val.lower():
-                        metrics[group]['default_address'] += 1
-                        break
-    return metrics
+        companies['acc_due'].to_numpy() < today,
+        # Default office address? If not, count each director whose service address is the default
+        np.where(companies['reg_addr_default'], 1, companies['officer_default']),
+    ]
+    totals = np.zeros((len(groups), len(keys)), dtype=np.uint32)
+    for col, flag in enumerate(flags):
+        totals[:, col] = np.bincount(group_index, weights=flag, minlength=len(groups))
+
+    return {
+        group: {key: int(totals[row, col]) for col, key in enumerate(keys)}
+        for row, group in enumerate(groups)
+    }
 
 def display_compliance_indicators(counts, metrics):
     print("\nCompliance indicators by group:")
@@ -192,8 +372,7 @@ def display_compliance_indicators(counts, metrics):
             ('default_address', 'Default office address')
         ]:
             count = metrics[group][key]
-            p = count / n if n else 0
-            moe_metric = Z95 * math.sqrt(p * (1 - p) / n) if n else 0
+            p, moe_metric = proportion_moe(count, n, Z95)
             print(f"  {label}: {count:,} ({p*100:.2f}% ±{moe_metric*100:.2f}%)")
 
 
@@ -202,57 +381,10 @@ def calculate_and_print_default_address_ratio(counts, metrics, Z95):
     Calculates the ratio of default address usage between 'without_uk' and 'with_uk' groups
     and its margin of error, then prints it.
     """
-    stats_for_ratio = {}
-    # Calculate proportions and their margins of error for default_address
-    for group in ['with_uk', 'without_uk']:
-        n = counts[group]
-        count = metrics[group]['default_address']
-        
-        p = 0.0
-        if n > 0:
-            p = count / n
-        
-        moe_p = 0.0
-        if n > 0 and p > 0 and p < 1: # Standard formula for MOE of a proportion
-            moe_p = Z95 * math.sqrt(p * (1 - p) / n)
-        elif n > 0 and (p == 0 or p == 1): # If p is 0 or 1, MOE is technically 0 by Wald interval for large n.
-                                        # For small n, other CI methods might be preferred but we stick to script's method.
-            moe_p = Z95 * math.sqrt(p * (1 - p) / n) # This will evaluate to 0
-
-        stats_for_ratio[group] = {'p': p, 'moe_p': moe_p, 'n': n, 'count': count}
-
-    p_uk = stats_for_ratio['with_uk']['p']
-    moe_p_uk = stats_for_ratio['with_uk']['moe_p']
-    p_foreign = stats_for_ratio['without_uk']['p']
-    moe_p_foreign = stats_for_ratio['without_uk']['moe_p']
-
-    ratio = p_foreign / p_uk
-
-    # Calculate margin of error for the ratio R = P_foreign / P_uk
-    # (MOE_R / R)^2 = (MOE_P_foreign / P_foreign)^2 + (MOE_P_uk / P_uk)^2
-    # MOE_R = R * sqrt((MOE_P_foreign / P_foreign)^2 + (MOE_P_uk / P_uk)^2)
-    
-    # Handle cases where proportions might be zero for relative error calculation
-    rel_err_sq_foreign = 0.0
-    if p_foreign > 0 and moe_p_foreign > 0: # moe_p can be 0 if p is 0 or 1
-        rel_err_sq_foreign = (moe_p_foreign / p_foreign)**2
-    
-    rel_err_sq_uk = 0.0
-    if p_uk > 0 and moe_p_uk > 0: # moe_p_uk can be 0 if p_uk is 0 or 1
-        rel_err_sq_uk = (moe_p_uk / p_uk)**2
-    
-    # If a proportion is 0 (and its MOE is 0), its term in the sum of relative errors squared is 0.
-    # If a proportion is 1 (and its MOE is 0), its term is also 0.
-    # If a MOE is 0 because p=0 or p=1 (perfect certainty for the sample), 
-    # it implies no uncertainty from that term for the ratio's error.
-
-    moe_ratio = 0.0
-    if ratio != 0 : # If ratio is 0 (because p_foreign is 0), then moe_ratio is 0
-        # (assuming moe_p_foreign is also 0 when p_foreign is 0)
-        if rel_err_sq_foreign > 0 or rel_err_sq_uk > 0:
-             moe_ratio = abs(ratio) * math.sqrt(rel_err_sq_foreign + rel_err_sq_uk)
-        # If both rel_err_sq are 0 (e.g. both p are 1.0 with 0 MOE), moe_ratio is 0.
-
+    ratio, moe_ratio = ratio_moe(
+        metrics['without_uk']['default_address'], counts['without_uk'],
+        metrics['with_uk']['default_address'], counts['with_uk'],
+        Z95)
 
     print(f"\nRatio of fraud in foreign vs UK companies: {ratio:.2f} ±{moe_ratio:.2f}")
     
@@ -261,15 +393,17 @@ def main():
     
     
     uk_variants = load_UK_variants()
-    sampled = load_sampled_companies(INPUT_FILE)
+    
+    # flattened once as the file is read, shared by all the analyses below
+    companies, officers = build_frames(iter_sampled_companies(INPUT_FILE), uk_variants)
     
     
-    print(f"\nLoaded {len(sampled)} sampled companies.")
+    print(f"\nLoaded {len(companies)} sampled companies.")
     
-    inspect_countries(sampled, uk_variants)
+    inspect_countries(extract_director_countries(officers), uk_variants)
 
-    counts = count_foreign_and_uk_directors(sampled, uk_variants)
-    metrics = analyze_compliance(sampled, uk_variants)    
+    counts = count_foreign_and_uk_directors(companies)
+    metrics = analyze_compliance(companies)    
     display_compliance_indicators(counts, metrics)
     calculate_and_print_default_address_ratio(counts, metrics, Z95)
 